@@ -1,103 +1,114 @@
 # algo.py — recommender utilities
-from algo_service import load_data
-from datetime import datetime, timedelta, timezone
-from dateutil import parser as dparser
-import collections
+from algo_service import (
+    build_groups_soa, build_members_csr, build_users_maps, get_snapshot, index_members,
+    load_candidates, normalize_groups, parse_dt,
+)
+from datetime import datetime, timezone
 import logging
+import threading
+import numpy as np
+from numba import njit, prange
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level="INFO")
 
-def parse_dt(v):
-    if v is None:
-        return None
-    if isinstance(v, datetime):
-        if v.tzinfo is None:
-            return v.replace(tzinfo=timezone.utc)
-        return v
-    try:
-        dt = dparser.parse(str(v))
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        return dt
-    except Exception:
-        return None
-
-def stops_to_route(start, stops, dest):
-    if not stops:
-        return [s for s in (start, dest) if s]
-    middle = [s.strip() for s in str(stops).split('|') if s and s.strip()]
-    route = []
-    if start:
-        route.append(start)
-    route.extend(middle)
-    if dest:
-        route.append(dest)
-    return route
-
-def build_graph(connections):
-    g = {}
-    for e in connections:
-        a = e.get("uid_a")
-        b = e.get("uid_b")
-        if a is None or b is None:
-            continue
-        g.setdefault(a, set()).add(b)
-        g.setdefault(b, set()).add(a)
-    return g
-
-def bfs_degrees(graph, source, max_depth=10):
-    if source is None:
-        return {}
-    q = collections.deque([(source, 0)])
-    seen = {source: 0}
-    while q:
-        u, d = q.popleft()
+@njit(cache=True)
+def bfs_degrees_csr(indptr, indices, source, max_depth):
+    n = indptr.shape[0] - 1
+    seen = np.full(n, -1, dtype=np.int32)
+    queue = np.empty(n, dtype=np.int32)
+    seen[source] = 0
+    queue[0] = source
+    head = 0
+    tail = 1
+    while head < tail:
+        u = queue[head]
+        head += 1
+        d = seen[u]
         if d >= max_depth:
             continue
-        for v in graph.get(u, []):
-            if v not in seen:
+        for k in range(indptr[u], indptr[u + 1]):
+            v = indices[k]
+            if seen[v] == -1:
                 seen[v] = d + 1
-                q.append((v, d + 1))
+                queue[tail] = v
+                tail += 1
     return seen
 
-def build_users_maps(users_list):
-    by_uid = {}
-    by_roll = {}
-    for u in users_list:
-        uid = u.get("uid")
-        if uid is not None:
-            by_uid[uid] = u
-        roll = u.get("roll_no")
-        if roll:
-            by_roll[roll] = u
-    return by_uid, by_roll
-
-def normalize_groups(groups_raw):
-    out = []
-    for g in groups_raw:
-        g2 = dict(g)
-        g2["route"] = stops_to_route(g.get("start"), g.get("stops"), g.get("dest"))
-        g2["departure_dt"] = parse_dt(g.get("departure_date"))
-        out.append(g2)
-    return out
+def member_degrees(graph, seeker_uid, max_degree, member_uids, member_idx):
+    source = graph["uid_to_idx"].get(seeker_uid)
+    if source is None:
+        return {}
+    depth = bfs_degrees_csr(graph["indptr"], graph["indices"], source, max_degree)
+    d = depth[member_idx]
+    mask = d >= 0
+    degrees = dict(zip(member_uids[mask].tolist(), d[mask].tolist()))
+    degrees[seeker_uid] = 0
+    return degrees
+
+@njit(parallel=True, cache=True)
+def score_groups_nb(capacity, member_count, preference_match, departure_ts, desired_ts, now_ts):
+    n = capacity.shape[0]
+    score = np.empty(n, dtype=np.float64)
+    seats_left = np.empty(n, dtype=np.int32)
+    delta = np.empty(n, dtype=np.float64)
+    use_desired = not np.isnan(desired_ts)
+    for i in prange(n):
+        seats = capacity[i] - member_count[i]
+        if seats < 0:
+            seats = 0
+        seats_left[i] = seats
+        s = seats * 10.0
+        if preference_match[i]:
+            s += 20.0
+        dep = departure_ts[i]
+        if np.isnan(dep):
+            delta[i] = np.inf
+        elif use_desired:
+            d = abs(dep - desired_ts)
+            s -= min(d / 3600.0, 48.0) * 2.0
+            delta[i] = d
+        else:
+            d = abs(dep - now_ts)
+            s -= min(d / 3600.0, 24.0)
+            delta[i] = d
+        score[i] = s
+    return score, seats_left, delta
+
+# Numba's default workqueue threading layer must not be entered from
+# several threads at once (Flask serves requests on threads).
+_score_lock = threading.Lock()
+
+def select_top_n(keys, candidates, n):
+    # Lexicographic top-n over `keys` (most significant first, ascending)
+    # without sorting every candidate: each level partitions on one key,
+    # keeps the rows strictly ahead of the cut-off and only carries the
+    # rows tied with it down to the next key.
+    picked = []
+    idx = candidates
+    for key in keys:
+        if idx.size <= n:
+            break
+        k = key[idx]
+        kth = k[np.argpartition(k, n - 1)[n - 1]]
+        ahead = k < kth
+        picked.append(idx[ahead])
+        n -= int(np.count_nonzero(ahead))
+        idx = idx[k == kth]
+    picked.append(idx[:n])
+    sel = np.concatenate(picked)
+    order = np.lexsort([key[sel] for key in reversed(keys)])
+    return sel[order]
 
 def recommend_for_seeker_with_degrees(seeker_roll, desired_departure=None, top_n=10, max_degree=5, time_window_mins=60):
-    data = load_data()
-    users = data.get("users", [])
-    groups = data.get("groups", [])
-    group_members = data.get("group_members", {})
-    connections = data.get("connections", [])
-
-    users_by_uid, users_by_roll = build_users_maps(users)
-    seeker = users_by_roll.get(seeker_roll)
+    derived = get_snapshot()
+    users_by_uid = derived["users_by_uid"]
+    seeker = derived["users_by_roll"].get(seeker_roll)
     if not seeker:
         return []
 
     seeker_uid = seeker.get("uid")
-    graph = build_graph(connections)
-    degrees = bfs_degrees(graph, seeker_uid, max_depth=max_degree)
-    groups_norm = normalize_groups(groups)
+    graph = derived["graph"]
     now = datetime.now(timezone.utc)
 
     desired_dt = None
@@ -106,72 +117,68 @@ def recommend_for_seeker_with_degrees(seeker_roll, desired_departure=None, top_n
         if desired_dt is None:
             desired_dt = None
 
-    results = []
-    for g in groups_norm:
-        gid = g.get("gid")
-        members = group_members.get(gid, [])
-        seats_left = max(0, (g.get("capacity") or 0) - len(members))
-        route = g.get("route")
-        departure_dt = g.get("departure_dt")
-        pref = g.get("preference")
-        score = seats_left * 10
-        if seeker.get("gender") and pref and seeker.get("gender") == pref:
-            score += 20
-
-        if desired_dt and departure_dt:
-            delta_hours = abs((departure_dt - desired_dt).total_seconds()) / 3600.0
-            score -= min(delta_hours, 48) * 2.0
-        elif departure_dt:
-            delta_hours = abs((departure_dt - now).total_seconds()) / 3600.0
-            score -= min(delta_hours, 24) * 1.0
-
-        mutuals = []
-        for m in members:
-            uid = m.get("uid")
-            deg = None
-            if uid in degrees:
-                deg = degrees.get(uid)
-                if deg == 0:
-                    deg = None
-            if deg is not None and uid != seeker_uid:
-                mutuals.append({"uid": uid, "degree": deg})
-
-        mutuals.sort(key=lambda x: x["degree"])
-        results.append({
-            "gid": gid,
-            "score": score,
-            "seats_left": seats_left,
-            "departure_dt": departure_dt,
-            "route": route,
-            "mutuals": mutuals
-        })
-
     if desired_dt:
-        window_ms = time_window_mins * 60 * 1000
-        filtered = []
-        for r in results:
-            dep = r.get("departure_dt")
-            if not dep:
-                continue
-            if abs((dep - desired_dt).total_seconds() * 1000) <= window_ms:
-                filtered.append(r)
-        results = filtered
-
-    for r in results:
-        r["departure_dt_sort"] = r["departure_dt"] or (datetime.max.replace(tzinfo=timezone.utc) - timedelta(days=3650))
+        cand = load_candidates(seeker_roll, desired_dt, time_window_mins)
+        groups_norm = normalize_groups(cand["groups"])
+        members = build_members_csr([g["members"] for g in cand["groups"]])
+        users_by_uid, _ = build_users_maps(cand["users"])
+        member_uids, member_idx = index_members(graph, members["member_uids_flat"])
+        soa = build_groups_soa(groups_norm, members)
+    else:
+        groups_norm = derived["groups_norm"]
+        members = derived["members"]
+        soa = derived["soa"]
+        member_uids = derived["member_uids"]
+        member_idx = derived["member_idx"]
+    degrees = member_degrees(graph, seeker_uid, max_degree, member_uids, member_idx)
+
+    gender = seeker.get("gender")
+    if gender:
+        gender_match = soa["preference"] == gender
+    else:
+        gender_match = np.zeros(len(groups_norm), dtype=np.bool_)
+    departure_ts = soa["departure_ts"]
+    desired_ts = desired_dt.timestamp() if desired_dt else np.nan
+    with _score_lock:
+        score, seats_left, delta = score_groups_nb(
+            soa["capacity"], soa["member_count"], gender_match, departure_ts, desired_ts, now.timestamp()
+        )
 
     if desired_dt:
-        results.sort(key=lambda x: (-x["score"], -x["seats_left"], abs((x["departure_dt_sort"] - desired_dt).total_seconds())))
+        candidates = np.flatnonzero(delta <= time_window_mins * 60)
+        tiebreak = delta
     else:
-        results.sort(key=lambda x: (-x["score"], -x["seats_left"], x["departure_dt_sort"]))
+        candidates = np.arange(len(groups_norm))
+        tiebreak = np.where(np.isnan(departure_ts), np.inf, departure_ts)
 
-    top = results[:top_n]
-    for t in top:
-        for m in t.get("mutuals", []):
+    if top_n <= 0 or candidates.size == 0:
+        return []
+    top_idx = select_top_n((-score, -seats_left, tiebreak), candidates, top_n)
+
+    in_network = {uid: deg for uid, deg in degrees.items() if deg > 0 and uid != seeker_uid}
+    member_indptr = members["member_indptr"]
+    member_uids_flat = members["member_uids_flat"]
+    top = []
+    for i in top_idx.tolist():
+        g = groups_norm[i]
+        gid = g.get("gid")
+        uids = member_uids_flat[member_indptr[i]:member_indptr[i + 1]]
+        member_uid_set = frozenset(uids.tolist())
+        mutuals = [{"uid": uid, "degree": in_network[uid]} for uid in member_uid_set & in_network.keys()]
+        mutuals.sort(key=lambda x: (x["degree"], x["uid"]))
+        for m in mutuals:
             u = users_by_uid.get(m["uid"])
             if u:
                 m["roll_no"] = u.get("roll_no")
                 m["name"] = u.get("name")
+        top.append({
+            "gid": gid,
+            "score": float(score[i]),
+            "seats_left": int(seats_left[i]),
+            "departure_dt": g.get("departure_dt"),
+            "route": g.get("route"),
+            "mutuals": mutuals
+        })
     return top
 
 if __name__ == "__main__":
@@ -5,11 +5,19 @@ import os
 import logging
 import threading
 import atexit
+import collections
+import fcntl
+import functools
+import pickle
+import time
+import weakref
+from datetime import datetime, timezone
+from dateutil import parser as dparser
 from typing import Dict, Any
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from psycopg2 import pool
-import psycopg2.extras
+import numpy as np
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 logging.basicConfig(level=LOG_LEVEL)
@@ -21,6 +29,7 @@ PGDATABASE = os.environ.get("PGDATABASE", os.environ.get("DB_NAME", "rideshare")
 PGUSER = os.environ.get("PGUSER")
 PGPASSWORD = os.environ.get("PGPASSWORD")
 DATABASE_URL = os.environ.get("DATABASE_URL")
+PG_MAXCONN = int(os.getenv("PG_MAXCONN", 32))
 
 _pool_lock = threading.Lock()
 _conn_pool = None
@@ -31,11 +40,11 @@ def get_pool():
         if _conn_pool is None:
             if DATABASE_URL:
                 logger.info("Creating connection pool from DATABASE_URL")
-                _conn_pool = pool.SimpleConnectionPool(1, 10, dsn=DATABASE_URL)
+                _conn_pool = pool.ThreadedConnectionPool(1, PG_MAXCONN, dsn=DATABASE_URL)
             else:
                 logger.info("Creating connection pool from PGHOST/PGUSER/PGDATABASE")
-                _conn_pool = pool.SimpleConnectionPool(
-                    1, 10,
+                _conn_pool = pool.ThreadedConnectionPool(
+                    1, PG_MAXCONN,
                     host=PGHOST or "localhost",
                     port=PGPORT,
                     database=PGDATABASE,
@@ -45,11 +54,11 @@ def get_pool():
         return _conn_pool
 
 def _get_conn():
-    p = get_pool()
+    p = _conn_pool or get_pool()
     return p.getconn()
 
 def _put_conn(conn):
-    p = get_pool()
+    p = _conn_pool or get_pool()
     p.putconn(conn)
 
 def close_pool():
@@ -64,38 +73,289 @@ def close_pool():
 
 atexit.register(close_pool)
 
+def build_csr(users, connections):
+    uid_to_idx = {}
+    for u in users:
+        uid = u.get("uid")
+        if uid is not None and uid not in uid_to_idx:
+            uid_to_idx[uid] = len(uid_to_idx)
+    src = []
+    dst = []
+    for a, b in connections:
+        if a is None or b is None:
+            continue
+        for uid in (a, b):
+            if uid not in uid_to_idx:
+                uid_to_idx[uid] = len(uid_to_idx)
+        ia = uid_to_idx[a]
+        ib = uid_to_idx[b]
+        src.extend((ia, ib))
+        dst.extend((ib, ia))
+    n = len(uid_to_idx)
+    src = np.asarray(src, dtype=np.int32)
+    dst = np.asarray(dst, dtype=np.int32)
+    order = np.argsort(src, kind="stable")
+    indices = dst[order]
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    return {"uid_to_idx": uid_to_idx, "indptr": indptr, "indices": indices}
+
+_PREPARED_STATEMENTS = (
+    "PREPARE p_users AS SELECT uid, roll_no, name, gender FROM users",
+    "PREPARE p_groups AS "
+    "SELECT gid, start, dest, string_to_array(coalesce(stops, ''), '|') AS stops_arr, "
+    "departure_date, capacity, preference, created_by FROM groups",
+    "PREPARE p_connections AS SELECT u1, u2 FROM connections",
+    """PREPARE p_candidates(timestamptz, int) AS
+    SELECT g.gid, g.start, g.dest, string_to_array(coalesce(g.stops, ''), '|') AS stops_arr,
+           g.departure_date, g.capacity, g.preference,
+           array_remove(array_agg(gm.uid ORDER BY gm.joined_at, gm.uid), NULL) AS members
+    FROM groups g
+    LEFT JOIN group_members gm USING (gid)
+    WHERE $1 IS NULL
+       OR g.departure_date BETWEEN $1 - $2 * interval '1 minute' AND $1 + $2 * interval '1 minute'
+    GROUP BY g.gid
+    ORDER BY g.gid""",
+    "PREPARE p_candidate_users(int[], text) AS "
+    "SELECT uid, roll_no, name, gender FROM users WHERE uid = ANY($1) OR roll_no = $2",
+)
+
+# Prepared statements live as long as the server session, so each pooled
+# connection is prepared once, on its first checkout.
+_prepared_conns = weakref.WeakKeyDictionary()
+
+def _ensure_prepared(conn):
+    if conn in _prepared_conns:
+        return
+    cur = conn.cursor()
+    try:
+        cur.execute(";\n".join(_PREPARED_STATEMENTS))
+    finally:
+        cur.close()
+    _prepared_conns[conn] = True
+
 def load_data() -> Dict[str, Any]:
     conn = _get_conn()
     try:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        # psycopg2 cannot return multiple result sets (cursor.nextset() is
+        # unsupported), so the four reads stay separate statements. With
+        # autocommit the driver skips its implicit BEGIN and the pool skips
+        # the ROLLBACK on putconn, leaving one round trip per SELECT.
+        conn.autocommit = True
+        _ensure_prepared(conn)
+        cur = conn.cursor()
+        try:
+            cur.execute("EXECUTE p_users")
+            users = [{"uid": r[0], "roll_no": r[1], "name": r[2], "gender": r[3]} for r in cur]
+            cur.execute("EXECUTE p_groups")
+            groups = [
+                {"gid": r[0], "start": r[1], "dest": r[2], "stops_arr": r[3], "departure_date": r[4],
+                 "capacity": r[5], "preference": r[6], "created_by": r[7]}
+                for r in cur
+            ]
+            # Named (server-side) cursors need a transaction; WITH HOLD lets this
+            # one stream in itersize batches on the autocommit connection.
+            # DECLARE cannot wrap EXECUTE, so this read is not prepared.
+            gm_cur = conn.cursor(name="gm_stream", withhold=True)
+            try:
+                gm_cur.itersize = 10000
+                gm_cur.execute("SELECT gid, uid FROM group_members")
+                group_members = collections.defaultdict(list)
+                for gid, uid in gm_cur:
+                    group_members[gid].append(uid)
+            finally:
+                gm_cur.close()
+            cur.execute("EXECUTE p_connections")
+            connections = cur.fetchall()
+            graph = build_csr(users, connections)
+            return {"users": users, "groups": groups, "group_members": group_members, "connections": connections, "graph": graph}
+        finally:
+            cur.close()
+    finally:
+        _put_conn(conn)
+
+def load_candidates(seeker_roll, desired_dt, window_mins) -> Dict[str, Any]:
+    conn = _get_conn()
+    try:
+        conn.autocommit = True
+        _ensure_prepared(conn)
+        cur = conn.cursor()
         try:
-            cur.execute("SELECT uid, roll_no, name, email, gender, year, contact_number FROM users")
-            users = cur.fetchall() or []
-            cur.execute("SELECT gid, start, dest, stops, departure_date, capacity, preference, created_by FROM groups")
-            groups = cur.fetchall() or []
-            cur.execute("SELECT gid, uid, role, is_admin, joined_at FROM group_members")
-            gm_rows = cur.fetchall() or []
-            group_members = {}
-            for r in gm_rows:
-                gid = r['gid']
-                group_members.setdefault(gid, []).append({
-                    "uid": r['uid'],
-                    "role": r.get('role'),
-                    "is_admin": r.get('is_admin'),
-                    "joined_at": r.get('joined_at')
-                })
-            cur.execute("SELECT u1 AS uid_a, u2 AS uid_b FROM connections")
-            conn_rows = cur.fetchall() or []
-            connections = [{"uid_a": r.get("uid_a"), "uid_b": r.get("uid_b")} for r in conn_rows]
-            return {"users": users, "groups": groups, "group_members": group_members, "connections": connections}
+            cur.execute("EXECUTE p_candidates(%s, %s)", (desired_dt, window_mins))
+            groups = [
+                {"gid": r[0], "start": r[1], "dest": r[2], "stops_arr": r[3], "departure_date": r[4],
+                 "capacity": r[5], "preference": r[6], "members": r[7]}
+                for r in cur
+            ]
+            uids = sorted({uid for g in groups for uid in g["members"]})
+            cur.execute("EXECUTE p_candidate_users(%s, %s)", (uids, seeker_roll))
+            users = [{"uid": r[0], "roll_no": r[1], "name": r[2], "gender": r[3]} for r in cur]
+            return {"groups": groups, "users": users}
         finally:
             cur.close()
     finally:
         _put_conn(conn)
 
+def parse_dt(v):
+    if v is None:
+        return None
+    if isinstance(v, datetime):
+        if v.tzinfo is None:
+            return v.replace(tzinfo=timezone.utc)
+        return v
+    return _parse_iso_str(str(v))
+
+@functools.lru_cache(maxsize=8192)
+def _parse_iso_str(s):
+    try:
+        dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            dt = dparser.parse(s)
+        except Exception:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+def build_route(start, stops_arr, dest):
+    route = []
+    if start:
+        route.append(start)
+    route.extend(s.strip() for s in stops_arr or () if s and s.strip())
+    if dest:
+        route.append(dest)
+    return tuple(route)
+
+def build_users_maps(users_list):
+    by_uid = {}
+    by_roll = {}
+    for u in users_list:
+        uid = u.get("uid")
+        if uid is not None:
+            by_uid[uid] = u
+        roll = u.get("roll_no")
+        if roll:
+            by_roll[roll] = u
+    return by_uid, by_roll
+
+def normalize_groups(groups_raw):
+    out = []
+    for g in groups_raw:
+        g2 = dict(g)
+        g2["route"] = build_route(g.get("start"), g.get("stops_arr"), g.get("dest"))
+        g2["departure_dt"] = parse_dt(g.get("departure_date"))
+        g2["departure_ts"] = g2["departure_dt"].timestamp() if g2["departure_dt"] else None
+        out.append(g2)
+    return out
+
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshot.pkl"))
+
+_snapshot = {"derived": None, "ts": 0}
+_snapshot_lock = threading.Lock()
+
+def build_derived(data):
+    users_by_uid, users_by_roll = build_users_maps(data.get("users", []))
+    graph = data["graph"]
+    groups_norm = normalize_groups(data.get("groups", []))
+    group_members = data.get("group_members", {})
+    members = build_members_csr([group_members.get(g.get("gid"), []) for g in groups_norm])
+    member_uids, member_idx = index_members(graph, members["member_uids_flat"])
+    return {
+        "users_by_uid": users_by_uid,
+        "users_by_roll": users_by_roll,
+        "graph": graph,
+        "members": members,
+        "soa": build_groups_soa(groups_norm, members),
+        "member_uids": member_uids,
+        "member_idx": member_idx,
+        "groups_norm": groups_norm,
+    }
+
+def build_members_csr(member_lists):
+    member_count = np.fromiter((len(ms) for ms in member_lists), dtype=np.int32, count=len(member_lists))
+    member_indptr = np.zeros(len(member_lists) + 1, dtype=np.int32)
+    np.cumsum(member_count, out=member_indptr[1:])
+    member_uids_flat = np.fromiter((uid for ms in member_lists for uid in ms), dtype=np.int64, count=int(member_indptr[-1]))
+    return {"member_count": member_count, "member_indptr": member_indptr, "member_uids_flat": member_uids_flat}
+
+def index_members(graph, member_uids_flat):
+    uid_to_idx = graph["uid_to_idx"]
+    member_uids = [uid for uid in np.unique(member_uids_flat).tolist() if uid in uid_to_idx]
+    member_idx = [uid_to_idx[uid] for uid in member_uids]
+    return np.asarray(member_uids, dtype=np.int64), np.asarray(member_idx, dtype=np.int32)
+
+def build_groups_soa(groups_norm, members):
+    n = len(groups_norm)
+    return {
+        "capacity": np.fromiter((g.get("capacity") or 0 for g in groups_norm), dtype=np.int32, count=n),
+        "member_count": members["member_count"],
+        "departure_ts": np.fromiter(
+            (np.nan if g.get("departure_ts") is None else g["departure_ts"] for g in groups_norm),
+            dtype=np.float64, count=n,
+        ),
+        "preference": np.array([g.get("preference") for g in groups_norm], dtype=object),
+    }
+
+def _read_snapshot_file(max_age):
+    try:
+        with open(SNAPSHOT_PATH, "rb") as f:
+            mtime = os.fstat(f.fileno()).st_mtime
+            if time.time() - mtime > max_age:
+                return None
+            return pickle.load(f), mtime
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.exception("Ignoring unreadable snapshot file %s", SNAPSHOT_PATH)
+        return None
+
+def _write_snapshot_file(derived):
+    tmp = "%s.%d.tmp" % (SNAPSHOT_PATH, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(derived, f, protocol=5)
+        os.replace(tmp, SNAPSHOT_PATH)
+    except Exception:
+        logger.exception("Failed to write snapshot file %s", SNAPSHOT_PATH)
+
+def _load_snapshot(max_age, use_file=True):
+    try:
+        lock_file = open(SNAPSHOT_PATH + ".lock", "a")
+    except OSError as e:
+        logger.warning("Snapshot file unavailable (%s); loading from database without persisting", e)
+        return build_derived(load_data()), time.time(), "database"
+    # The exclusive lock makes concurrent workers queue up behind whichever
+    # one is querying the database; the rest then pick up the fresh file.
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if use_file:
+            cached = _read_snapshot_file(max_age)
+            if cached is not None:
+                return cached + ("file",)
+        derived = build_derived(load_data())
+        _write_snapshot_file(derived)
+        return derived, time.time(), "database"
+
+def _install_snapshot(derived, ts, source):
+    _snapshot["derived"] = derived
+    _snapshot["ts"] = ts
+    logger.info("Snapshot loaded from %s: users=%d groups=%d", source, len(derived["users_by_uid"]), len(derived["groups_norm"]))
+
+def get_snapshot(max_age=30):
+    with _snapshot_lock:
+        if _snapshot["derived"] is None or time.time() - _snapshot["ts"] > max_age:
+            _install_snapshot(*_load_snapshot(max_age))
+        return _snapshot["derived"]
+
+def refresh_snapshot():
+    with _snapshot_lock:
+        _install_snapshot(*_load_snapshot(0, use_file=False))
+    _parse_iso_str.cache_clear()
+    return _snapshot["derived"]
+
 app = Flask(__name__)
 CORS(app, origins=os.getenv("CORS_ORIGIN", "*"))
-_cached_data = {"data": None, "loaded_at": None}
 
 @app.route("/health", methods=["GET"])
 def health():
@@ -114,18 +374,16 @@ def health():
     except Exception as e:
         logger.exception("DB health check failed")
         return jsonify({"ok": False, "error": "db_unavailable", "details": str(e)}), 500
-    model_loaded = bool(_cached_data["data"])
+    model_loaded = _snapshot["derived"] is not None
     return jsonify({"ok": True, "model_loaded": model_loaded}), 200
 
 @app.route("/reload-model", methods=["POST"])
 def reload_model():
     try:
-        d = load_data()
-        _cached_data["data"] = d
-        import time
-        _cached_data["loaded_at"] = time.time()
-        logger.info("Data reloaded: users=%d groups=%d", len(d.get("users", [])), len(d.get("groups", [])))
-        return jsonify({"ok": True, "msg": "data reloaded", "users": len(d.get("users", []))}), 200
+        derived = refresh_snapshot()
+        users = len(derived["users_by_uid"])
+        logger.info("Data reloaded: users=%d groups=%d", users, len(derived["groups_norm"]))
+        return jsonify({"ok": True, "msg": "data reloaded", "users": users}), 200
     except Exception as e:
         logger.exception("reload_model failed")
         return jsonify({"ok": False, "error": str(e)}), 500
@@ -136,18 +394,17 @@ def predict():
         payload = request.get_json(force=True, silent=True)
         if payload is None:
             return jsonify({"ok": False, "error": "empty json body"}), 400
-        if _cached_data["data"] is None:
-            try:
-                _cached_data["data"] = load_data()
-            except Exception as e:
-                logger.exception("predict: failed to load data")
-                return jsonify({"ok": False, "error": "failed_to_load_data", "details": str(e)}), 500
+        try:
+            derived = get_snapshot()
+        except Exception as e:
+            logger.exception("predict: failed to load data")
+            return jsonify({"ok": False, "error": "failed_to_load_data", "details": str(e)}), 500
         resp = {
             "ok": True,
             "received": payload,
             "db_summary": {
-                "users": len(_cached_data["data"].get("users", [])),
-                "groups": len(_cached_data["data"].get("groups", [])),
+                "users": len(derived["users_by_uid"]),
+                "groups": len(derived["groups_norm"]),
             }
         }
         return jsonify(resp), 200
@@ -159,8 +416,7 @@ if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
     debug = os.getenv("FLASK_DEBUG", "0") == "1"
     try:
-        _cached_data["data"] = load_data()
-        logger.info("Initial data loaded (users=%d)", len(_cached_data["data"].get("users", [])))
+        get_snapshot()
     except Exception as e:
-        logger.warning("Initial data load failed: %s", e)
+        logger.warning("Initial snapshot load failed: %s", e)
     app.run(host="0.0.0.0", port=port, debug=debug)
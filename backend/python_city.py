@@ -3,6 +3,10 @@ import os
 import urllib.request
 import zipfile
 
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+
 DATA_DIR = "data"
 os.makedirs(DATA_DIR, exist_ok=True)
 
@@ -57,50 +61,69 @@ with open(ADMIN1, "r", encoding="utf-8") as f:
 
 
 
-cities = set()
-
-with open(IN_TXT, "r", encoding="utf-8") as f:
-    for line in f:
-        parts = line.rstrip("\n").split("\t")
-        if len(parts) < 19:
-            continue
-
-        name = parts[1].strip()
-        fclass = parts[6]
-        fcode  = parts[7]
-        cc     = parts[8]
-        admin1 = parts[10]
-
-        try:
-            pop = int(parts[14]) if parts[14] else 0
-        except:
-            pop = 0
-
-        if cc != "IN":
-            continue
-        if fclass != "P" or fcode not in KEEP_FEATURES:
-            continue
-        if pop < MIN_POP:
-            continue
-
-        key = f"IN.{admin1}"
-        state_name, _ = state_code_to_name.get(key, (None, admin1))
-
-        if not state_name:
-            continue
-        
-        
-        if KEEP_STATES and state_name not in KEEP_STATES:
-            continue
-
-        cities.add(name)
-
-
-
+# admin1 codes (the part after "IN.") whose state we keep
+keep_admin1 = pa.array(sorted(
+    key.split(".", 1)[1]
+    for key, (name, _) in state_code_to_name.items()
+    if key.startswith("IN.") and name and (not KEEP_STATES or name in KEEP_STATES)
+))
+keep_features = pa.array(sorted(KEEP_FEATURES))
+
+GEONAMES_COLUMNS = [
+    "geonameid", "name", "asciiname", "alternatenames", "latitude", "longitude",
+    "fclass", "fcode", "cc", "cc2", "admin1", "admin2", "admin3", "admin4",
+    "population", "elevation", "dem", "timezone", "modified",
+]
+USED_COLUMNS = ["name", "fclass", "fcode", "cc", "admin1", "population"]
+
+# Rows with fewer than 19 fields are dropped, as before. Rows with extra
+# trailing fields are kept on their first 19 fields, so they are collected
+# here and filtered after the streamed batches.
+long_rows = []
+
+def handle_invalid_row(row):
+    if row.actual_columns > row.expected_columns:
+        long_rows.append(row.text.split("\t")[:len(GEONAMES_COLUMNS)])
+    return "skip"
+
+def city_names(batch):
+    pop_str = batch.column("population")
+    pop = pc.cast(pc.if_else(pc.match_substring_regex(pop_str, r"^-?\d+$"), pop_str, "0"), pa.int64())
+    mask = pc.and_(
+        pc.and_(pc.equal(batch.column("cc"), "IN"), pc.equal(batch.column("fclass"), "P")),
+        pc.and_(
+            pc.and_(pc.is_in(batch.column("fcode"), value_set=keep_features), pc.greater_equal(pop, MIN_POP)),
+            pc.is_in(batch.column("admin1"), value_set=keep_admin1),
+        ),
+    )
+    return pc.utf8_trim_whitespace(pc.filter(batch.column("name"), mask))
+
+reader = pacsv.open_csv(
+    IN_TXT,
+    read_options=pacsv.ReadOptions(column_names=GEONAMES_COLUMNS, block_size=1 << 24),
+    parse_options=pacsv.ParseOptions(delimiter="\t", quote_char=False, invalid_row_handler=handle_invalid_row),
+    convert_options=pacsv.ConvertOptions(
+        include_columns=USED_COLUMNS,
+        column_types={c: pa.string() for c in USED_COLUMNS},
+        strings_can_be_null=False,
+    ),
+)
+
+names = [city_names(batch) for batch in reader]
+if long_rows:
+    names.append(city_names(pa.RecordBatch.from_pydict({
+        c: pa.array([r[GEONAMES_COLUMNS.index(c)] for r in long_rows], type=pa.string())
+        for c in USED_COLUMNS
+    })))
+
+cities = pc.unique(pa.chunked_array(names, type=pa.string()))
+cities = cities.take(pc.array_sort_indices(cities))
+
+# Arrow's CSV writer quotes every string value; csv.writer keeps the
+# existing minimal quoting for the (already filtered) sorted names.
 with open(OUTPUT_CSV, "w", newline="", encoding="utf-8") as f:
     writer = csv.writer(f)
     writer.writerow(["city_name"])
-    for city in sorted(cities):
-        writer.writerow([city])
+    writer.writerows([city] for city in cities.to_pylist())
 
 print(f"✅ Wrote {len(cities)} cities to {OUTPUT_CSV}")
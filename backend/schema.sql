@@ -22,6 +22,8 @@ CREATE TABLE IF NOT EXISTS groups (
   created_at TIMESTAMP WITH TIME ZONE DEFAULT now()
 );
 
+CREATE INDEX IF NOT EXISTS groups_departure_date_idx ON groups(departure_date);
+
 CREATE TABLE IF NOT EXISTS group_members (
   gid INT REFERENCES groups(gid),
   uid INT REFERENCES users(uid),